@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
 import os
 import re
 from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import quote, unquote
 
 import bs4
 from bs4 import BeautifulSoup
 import requests
 
+SOURCES_FILE = "sources.json"
+FONT_EXTENSIONS = (".ttf", ".otf", ".woff", ".woff2", ".eot")
+
 
 class Localizer:
     def __init__(
@@ -24,6 +30,14 @@ class Localizer:
         self.base_url = None
         self.overwrite_assets = overwrite_assets
 
+        # maps the path of each localized asset (relative to the root
+        # directory) to the URL it was downloaded from, so that broken
+        # assets can be re-fetched later on
+        self.sources = {}
+        # URLs that could not be downloaded, so they are not requested
+        # again for every page that refers to them
+        self.failed_urls = set()
+
         self.root_dir = root_dir
         self.issue_dir = os.path.join(root_dir, issue_dir)
 
@@ -53,11 +67,7 @@ class Localizer:
         # download all stylesheets and refer to local copy
         css = soup.head.find_all("link", rel="stylesheet")
         for ss in css:
-            ss["href"] = self.localize_item(
-                ss["href"],
-                rel_dir=os.path.join("..", self.styles_dir),
-                abs_dir=os.path.join(self.root_dir, self.styles_dir),
-                formatter=self.localize_css)
+            ss["href"] = self.localize_stylesheet(ss["href"])
 
         styles = soup.find_all("style")
         for style in styles:
@@ -73,11 +83,7 @@ class Localizer:
 
         og_image = soup.head.find("meta", property="og:image")
         if og_image is not None:
-            og_image["content"] = self.localize_item(
-                og_image["content"],
-                rel_dir=self.images_dir,
-                abs_dir=os.path.join(self.issue_dir, self.images_dir),
-                binary=True)
+            og_image["content"] = self.localize_image(og_image["content"])
 
         # remove "web-smart" banner
         bootstrap = soup.head.find("script", class_="KGPugpigReader-bootstrap")
@@ -92,10 +98,7 @@ class Localizer:
             if "google" in j["src"]:
                 remove_elem(j)
             else:
-                j["src"] = self.localize_item(
-                    j["src"],
-                    rel_dir=os.path.join("..", self.scripts_dir),
-                    abs_dir=os.path.join(self.root_dir, self.scripts_dir))
+                j["src"] = self.localize_script(j["src"])
 
         # download all images
         img = soup.find_all("img")
@@ -107,11 +110,7 @@ class Localizer:
                 if "preload" in i["class"]:
                     i["class"].remove("preload")
 
-                i["src"] = self.localize_item(
-                    i["src"],
-                    rel_dir=self.images_dir,
-                    abs_dir=os.path.join(self.issue_dir, self.images_dir),
-                    binary=True)
+                i["src"] = self.localize_image(i["src"])
 
         # localize any links that refer to other pages in the issue
         links = soup.find_all("a")
@@ -130,6 +129,32 @@ class Localizer:
 
         return soup.prettify()
 
+    def localize_stylesheet(self, url: str) -> str:
+        """Downloads a stylesheet (and the resources it refers to) and
+        returns the path to the local copy, relative to the issue."""
+        return self.localize_item(
+            url,
+            rel_dir=os.path.join("..", self.styles_dir),
+            abs_dir=os.path.join(self.root_dir, self.styles_dir),
+            formatter=self.localize_css)
+
+    def localize_script(self, url: str) -> str:
+        """Downloads a script and returns the path to the local copy,
+        relative to the issue."""
+        return self.localize_item(
+            url,
+            rel_dir=os.path.join("..", self.scripts_dir),
+            abs_dir=os.path.join(self.root_dir, self.scripts_dir))
+
+    def localize_image(self, url: str) -> str:
+        """Downloads an image and returns the path to the local copy,
+        relative to the issue."""
+        return self.localize_item(
+            url,
+            rel_dir=self.images_dir,
+            abs_dir=os.path.join(self.issue_dir, self.images_dir),
+            binary=True)
+
     def localize_item(
             self,
             url: str,
@@ -139,13 +164,22 @@ class Localizer:
             formatter: Optional[Callable[[str, str, Dict[str, str]], str]] = None) -> str:
         """Takes a URL, downloads the resource locally, and returns
         the local path where it can be found."""
-        url_parts = url.split("/")
-        rel_path = os.path.join(rel_dir, url_parts[-1])
-        abs_path = os.path.join(abs_dir, url_parts[-1])
+        filename = asset_filename(url)
+        # the path is written into a page or stylesheet, so it must be
+        # URL-encoded to refer to the file name on disk
+        rel_path = quote(os.path.join(rel_dir, filename).replace(os.sep, "/"))
+        abs_path = os.path.join(abs_dir, filename)
 
         # only re-download if we don't already have the resource
         if self.overwrite_assets or not os.path.exists(abs_path):
-            r = requests.get(url)
+            if url in self.failed_urls:
+                return url
+            try:
+                r = requests.get(url)
+            except requests.RequestException:
+                print(f"Error downloading file {url}")
+                self.failed_urls.add(url)
+                return url
             if r.status_code == 200:
                 if binary:
                     localized_content = r.content
@@ -159,12 +193,28 @@ class Localizer:
                         localized_text = formatter(localized_text, url)
                     with open(abs_path, "wt") as f:
                         f.write(localized_text)
+                self.record_source(abs_path, url)
                 return rel_path
             else:
                 print(f"Error downloading file {url}")
+                self.failed_urls.add(url)
                 return url
+        self.record_source(abs_path, url)
         return rel_path
 
+    def record_source(self, abs_path: str, url: str) -> None:
+        """Keeps track of the URL a local asset was downloaded from."""
+        self.sources[source_key(abs_path, self.root_dir)] = url
+
+    def save_sources(self) -> None:
+        """Merges the recorded asset sources into the sources file in
+        the root directory."""
+        sources_path = os.path.join(self.root_dir, SOURCES_FILE)
+        sources = load_sources(self.root_dir)
+        sources.update(self.sources)
+        with open(sources_path, "w") as f:
+            json.dump(sources, f, indent=2, sort_keys=True)
+
     def localize_one_css_url(self, match_obj: re.Match, orig_url: str, in_subdir: bool = True) -> str:
         """Given a match object matching a 'url()' CSS expression,
         this pulls the appropriate resource and returns a localized
@@ -173,27 +223,35 @@ class Localizer:
         if url.startswith("'data:") or url.startswith("#"):
             # this is an SVG element
             return match_obj.group(0)
-        if url.startswith("/"):
+        if url.startswith("//"):
+            # protocol-relative URL
+            url = "https:" + url
+        elif url.startswith("/"):
             # add the domain to the beginning
             url = self.domain + url
         if url.startswith("."):
             url = url_rel_to_abs(url, orig_url)
-        if url.lower().endswith((".ttf", ".otf", ".woff", ".woff2", ".eot")):
-            rel_dir = os.path.join("..", self.fonts_dir)
+        if asset_filename(url).lower().endswith(FONT_EXTENSIONS):
             abs_dir = os.path.join(self.root_dir, self.fonts_dir)
         else:
-            rel_dir = self.images_dir
             abs_dir = os.path.join(self.issue_dir, self.images_dir)
+
+        # paths in a stylesheet are relative to the stylesheet itself,
+        # while paths in inline styles are relative to the page
+        if in_subdir:
+            css_dir = os.path.join(self.root_dir, self.styles_dir)
+        else:
+            css_dir = self.issue_dir
         rel_path = self.localize_item(
             url,
-            rel_dir=rel_dir,
+            rel_dir=os.path.relpath(abs_dir, css_dir),
             abs_dir=abs_dir,
             binary=True)
 
-        if in_subdir:
-            return f'url("{os.path.join("..", rel_path)}")'
-        else:
-            return f'url("{rel_path}")'
+        if rel_path == url:
+            # the download failed, so leave the reference as it was
+            return match_obj.group(0)
+        return f'url("{rel_path}")'
 
     def localize_css(self, raw_data: str, orig_url: str, in_subdir: bool = True) -> str:
         """Searches text for 'url()' and replaces with an absolute
@@ -207,6 +265,43 @@ def remove_elem(elem: Optional[bs4.element.Tag]):
         elem.decompose()
 
 
+def load_sources(root_dir: str = "") -> Dict[str, str]:
+    """Loads the mapping of local asset paths (relative to the root
+    directory) to the URLs they were downloaded from."""
+    sources_path = os.path.join(root_dir, SOURCES_FILE)
+    if not os.path.exists(sources_path):
+        return {}
+    with open(sources_path, "r") as f:
+        return json.load(f)
+
+
+def asset_filename(url: str) -> str:
+    """Returns the name of the local file that a resource is saved
+    to, which is the last part of its URL path. If the URL has a query
+    string, a short hash of it is added to the name, so that resources
+    which only differ by their query are saved to different files."""
+    path, _, query = url.split("#")[0].partition("?")
+    filename = path.split("/")[-1]
+
+    # only decode the name if it stays a plain file name
+    decoded = unquote(filename)
+    if not any(c in decoded for c in "/\\?#"):
+        filename = decoded
+
+    if query:
+        base, ext = os.path.splitext(filename)
+        query_hash = hashlib.sha1(query.encode("utf-8")).hexdigest()[:8]
+        filename = f"{base}-{query_hash}{ext}"
+    return filename
+
+
+def source_key(abs_path: str, root_dir: str = "") -> str:
+    """Returns the key that a local asset is stored under in the
+    sources file: its path relative to the root directory."""
+    key = os.path.relpath(abs_path, root_dir or os.curdir)
+    return key.replace(os.sep, "/")
+
+
 def url_rel_to_abs(relative_url: str, from_url: str) -> str:
     """Converts a relative URL to an absolute URL, given the
     (absolute) URL of the resource where it came from."""
@@ -0,0 +1,183 @@
+import os
+from unittest import mock
+
+import pytest
+
+import verify
+from localize import Localizer, asset_filename
+
+
+def write(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class RecordingExecutor:
+    """Runs scans in the current process and records which files were
+    scanned."""
+    def __init__(self):
+        self.scanned = []
+
+    def map(self, fn, paths, chunksize=1):
+        paths = list(paths)
+        self.scanned.extend(paths)
+        return map(fn, paths)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, "Issue 01", "page1.html"), """
+<html><head><link rel="stylesheet" href="../common/styles/main.css"></head>
+<body>
+<img src="img/ok.png"><img src="img/empty.png"><img src="img/gone.png">
+<img src="https://example.com/remote.png">
+<a href="page2.html">next</a><a href="https://example.com">external</a>
+</body></html>
+""")
+    write(os.path.join(root, "Issue 01", "img", "ok.png"), "data")
+    write(os.path.join(root, "Issue 01", "img", "empty.png"))
+    write(os.path.join(root, "Issue 01", "img", "bg.png"), "data")
+    write(os.path.join(root, "common", "styles", "main.css"),
+          '.a { background: url("../img/bg.png"); }')
+    return root
+
+
+def test_verify_archive_detects_problems(archive):
+    problems, stylesheets = verify.verify_archive(archive, jobs=1)
+    page = os.path.join("Issue 01", "page1.html")
+    css = os.path.join("common", "styles", "main.css")
+
+    kinds = {(problem, url) for problem, url, _ in problems[page]}
+    assert kinds == {
+        ("empty", "img/empty.png"),
+        ("missing", "img/gone.png"),
+        ("remote", "https://example.com/remote.png"),
+        ("broken-link", "page2.html"),
+    }
+    assert problems[css] == [
+        ("misplaced", "../img/bg.png", os.path.join(archive, "Issue 01", "img", "bg.png")),
+    ]
+    assert stylesheets == {css: "Issue 01"}
+
+
+def test_collect_references_uses_cache(archive):
+    page = os.path.join("Issue 01", "page1.html")
+    page_path = os.path.join(archive, page)
+    cache = {}
+
+    executor = RecordingExecutor()
+    first = verify.collect_references(archive, [page], cache, executor)
+    assert executor.scanned == [page_path]
+
+    # unchanged file is not scanned again
+    executor = RecordingExecutor()
+    assert verify.collect_references(archive, [page], cache, executor) == first
+    assert executor.scanned == []
+
+    # nor is it when the cache is ignored, though the cache is refreshed
+    executor = RecordingExecutor()
+    verify.collect_references(archive, [page], cache, executor, use_cache=False)
+    assert executor.scanned == [page_path]
+
+    # a different modification time is a miss
+    st = os.stat(page_path)
+    os.utime(page_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    executor = RecordingExecutor()
+    verify.collect_references(archive, [page], cache, executor)
+    assert executor.scanned == [page_path]
+
+    # as is a different size, even with the same modification time
+    st = os.stat(page_path)
+    with open(page_path, "a") as f:
+        f.write('<img src="img/new.png">')
+    os.utime(page_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    executor = RecordingExecutor()
+    refs = verify.collect_references(archive, [page], cache, executor)
+    assert executor.scanned == [page_path]
+    assert ("image", "img/new.png") in refs[page]
+
+
+def test_cache_keeps_other_entries(archive):
+    verify.verify_archive(archive, jobs=1)
+    verify.verify_archive(archive, issues=[2], jobs=1, use_cache=False)
+    assert os.path.join("Issue 01", "page1.html") in verify.load_cache(archive)
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://example.com/img/a.png", "a.png"),
+    ("https://example.com/img/a.png#frag", "a.png"),
+    ("https://example.com/img/a%20b.png", "a b.png"),
+    ("https://example.com/img/a%2Fb.png", "a%2Fb.png"),
+    ("https://example.com/img/a%3Fb.png", "a%3Fb.png"),
+])
+def test_asset_filename(url, expected):
+    assert asset_filename(url) == expected
+
+
+def test_asset_filename_with_query():
+    first = asset_filename("https://example.com/thumb.php?id=1")
+    second = asset_filename("https://example.com/thumb.php?id=2")
+    assert first != second
+    assert first.startswith("thumb-") and first.endswith(".php")
+    assert asset_filename("https://example.com/thumb.php?id=1") == first
+
+
+@pytest.mark.parametrize("url", [
+    "https://example.com/img/a%20b.png",
+    "https://example.com/img/a%2Fb.png",
+    "https://example.com/img/a%3Fb.png",
+    "https://example.com/img/thumb.php?id=1",
+])
+def test_localized_path_resolves_to_file(tmp_path, url):
+    root = str(tmp_path)
+    localizer = Localizer(domain="https://example.com", issue_urls={}, root_dir=root, issue_dir="Issue 01")
+    response = mock.Mock(status_code=200, content=b"data")
+    with mock.patch("localize.requests.get", return_value=response):
+        rel_path = localizer.localize_image(url)
+
+    base_dir = os.path.join(root, "Issue 01")
+    assert verify.check_reference("image", rel_path, base_dir) is None
+
+
+def test_relink_css(archive):
+    css_path = os.path.join(archive, "common", "styles", "main.css")
+    image_path = os.path.join(archive, "Issue 01", "img", "bg.png")
+    verify.relink_css(css_path, {"../img/bg.png": image_path})
+
+    with open(css_path, "r") as f:
+        assert f.read() == '.a { background: url("../../Issue%2001/img/bg.png"); }'
+    base_dir = os.path.dirname(css_path)
+    assert verify.check_reference("css-url", "../../Issue%2001/img/bg.png", base_dir) is None
+
+
+def test_refetch_skips_broken_links_and_keeps_failed_files(archive, capsys):
+    problems, stylesheets = verify.verify_archive(archive, jobs=1)
+    with open(os.path.join(archive, "sources.json"), "w") as f:
+        f.write('{"Issue 01/img/empty.png": "https://example.com/empty.png"}')
+
+    response = mock.Mock(status_code=404)
+    with mock.patch("localize.requests.get", return_value=response) as get:
+        verify.refetch_broken(archive, problems, stylesheets)
+
+    assert "page2.html" not in capsys.readouterr().out
+    # the failed download leaves the empty file in place, and is only
+    # tried once
+    assert os.path.exists(os.path.join(archive, "Issue 01", "img", "empty.png"))
+    assert [c.args[0] for c in get.call_args_list].count("https://example.com/empty.png") == 1
+
+
+def test_refetch_replaces_empty_file(archive):
+    problems, stylesheets = verify.verify_archive(archive, jobs=1)
+    with open(os.path.join(archive, "sources.json"), "w") as f:
+        f.write('{"Issue 01/img/empty.png": "https://example.com/empty.png"}')
+
+    response = mock.Mock(status_code=200, content=b"data")
+    with mock.patch("localize.requests.get", return_value=response):
+        verify.refetch_broken(archive, problems, stylesheets)
+
+    img_dir = os.path.join(archive, "Issue 01", "img")
+    with open(os.path.join(img_dir, "empty.png"), "rb") as f:
+        assert f.read() == b"data"
+    assert not os.path.exists(os.path.join(img_dir, "empty.png.broken"))
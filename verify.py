@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import re
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from bs4 import BeautifulSoup
+
+from localize import Localizer, load_sources, source_key
+
+DOMAIN = "https://dnd.dragonmag.com"
+
+CACHE_FILE = ".verify_cache.json"
+CACHE_VERSION = 1
+
+CSS_URL_PATTERN = re.compile(r"url\(['\"]?([^'\")]+)['\"]?\)")
+REMOTE_PREFIXES = ("http://", "https://", "//")
+IGNORED_PREFIXES = ("data:", "'data:", "#", "mailto:", "javascript:", "tel:", "about:")
+
+# a reference is a (kind, url) pair, where kind is one of
+# "stylesheet", "script", "image", "css-url" or "link"
+Reference = Tuple[str, str]
+
+# a problem is a (problem type, url, local path) triple, where
+# problem type is one of "remote", "missing", "empty", "misplaced" or
+# "broken-link"; for misplaced files, the local path is where the file
+# actually is
+Problem = Tuple[str, str, str]
+
+
+def find_issue_dirs(outdir: str) -> List[Tuple[int, str]]:
+    """Finds all the archived issue directories, and returns their
+    issue numbers and names, sorted by issue number."""
+    issue_dirs = []
+    for d in os.listdir(outdir):
+        match = re.fullmatch(r".*Issue ([0-9]+)", d)
+        if match and os.path.isdir(os.path.join(outdir, d)):
+            issue_dirs.append((int(match.group(1)), d))
+    return sorted(issue_dirs)
+
+
+def find_pages(outdir: str, issues: Optional[Iterable[int]] = None) -> List[str]:
+    """Finds all the archived pages, optionally restricted to a set of
+    issue numbers, and returns their paths relative to the outdir."""
+    if issues is not None:
+        issues = set(issues)
+
+    pages = []
+    for num, d in find_issue_dirs(outdir):
+        if issues is not None and num not in issues:
+            continue
+        for filename in os.listdir(os.path.join(outdir, d)):
+            page_match = re.fullmatch(r"page([0-9]+)\.html", filename)
+            if page_match:
+                pages.append((num, int(page_match.group(1)), os.path.join(d, filename)))
+
+    return [path for _, _, path in sorted(pages)]
+
+
+def scan_file(path: str) -> List[Reference]:
+    """Parses an archived HTML or CSS file and returns all the
+    references to other resources that it contains. This is the
+    expensive part of verification, so it is run in a process pool."""
+    with open(path, "r") as f:
+        raw_data = f.read()
+
+    if path.endswith(".css"):
+        return [("css-url", url) for url in CSS_URL_PATTERN.findall(raw_data)]
+
+    soup = BeautifulSoup(raw_data, 'html.parser')
+    refs = []
+    for ss in soup.find_all("link", rel="stylesheet", href=True):
+        refs.append(("stylesheet", ss["href"]))
+    for j in soup.find_all("script", src=True):
+        refs.append(("script", j["src"]))
+    for i in soup.find_all("img", src=True):
+        refs.append(("image", i["src"]))
+
+    og_image = soup.find("meta", property="og:image")
+    if og_image is not None and og_image.get("content"):
+        refs.append(("image", og_image["content"]))
+
+    for style in soup.find_all("style"):
+        if style.string is not None:
+            refs.extend(("css-url", url) for url in CSS_URL_PATTERN.findall(style.string))
+    for elem in soup.find_all(style=True):
+        refs.extend(("css-url", url) for url in CSS_URL_PATTERN.findall(elem["style"]))
+
+    for a in soup.find_all("a", href=True):
+        refs.append(("link", a["href"]))
+
+    return refs
+
+
+def is_remote(url: str) -> bool:
+    return url.startswith(REMOTE_PREFIXES)
+
+
+def resolve_local(url: str, base_dir: str) -> str:
+    """Converts a local reference into a file path, relative to the
+    directory of the file that contains the reference."""
+    path = unquote(url.split("#")[0].split("?")[0])
+    return os.path.normpath(os.path.join(base_dir, path))
+
+
+def check_reference(kind: str, url: str, base_dir: str) -> Optional[Problem]:
+    """Checks that a reference points to a local, non-empty file,
+    returning the problem if it does not."""
+    if not url or url.startswith(IGNORED_PREFIXES):
+        return None
+    if is_remote(url):
+        # links to other websites are fine, but any other resource
+        # should have been downloaded
+        if kind == "link":
+            return None
+        return ("remote", url, "")
+
+    path = resolve_local(url, base_dir)
+    if not os.path.isfile(path):
+        # a link to a page that does not exist is not an asset that
+        # can be re-fetched
+        if kind == "link":
+            return ("broken-link", url, path)
+        return ("missing", url, path)
+    if os.path.getsize(path) == 0:
+        return ("empty", url, path)
+    return None
+
+
+def find_misplaced(outdir: str, path: str, issue_dir: str) -> Optional[str]:
+    """Older versions of the localizer referred to images in
+    stylesheets as if they were in 'common/img', when they were really
+    saved to the image directory of an issue. This looks for such an
+    image, starting with the issue the stylesheet was localized for."""
+    filename = os.path.basename(path)
+    issue_dirs = [issue_dir] + [d for _, d in find_issue_dirs(outdir) if d != issue_dir]
+    for d in issue_dirs:
+        candidate = os.path.join(outdir, d, "img", filename)
+        if os.path.isfile(candidate) and os.path.getsize(candidate) > 0:
+            return candidate
+    return None
+
+
+def load_cache(outdir: str) -> Dict[str, Dict]:
+    """Loads the cached references of each previously scanned file."""
+    cache_path = os.path.join(outdir, CACHE_FILE)
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except ValueError:
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache["files"]
+
+
+def save_cache(outdir: str, cache: Dict[str, Dict]) -> None:
+    # drop entries for files that no longer exist
+    files = {k: v for k, v in cache.items() if os.path.exists(os.path.join(outdir, k))}
+    with open(os.path.join(outdir, CACHE_FILE), "w") as f:
+        json.dump({"version": CACHE_VERSION, "files": files}, f)
+
+
+def collect_references(
+        outdir: str,
+        rel_paths: Iterable[str],
+        cache: Dict[str, Dict],
+        executor: Executor,
+        use_cache: bool = True) -> Dict[str, List[Reference]]:
+    """Returns the references contained in each file. Files whose
+    modification time and size match the cache are not re-parsed
+    (unless use_cache is False); the rest are parsed in parallel and
+    the cache is updated."""
+    results = {}
+    to_scan = []
+    for rel in rel_paths:
+        st = os.stat(os.path.join(outdir, rel))
+        entry = cache.get(rel)
+        if use_cache and entry is not None and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            results[rel] = [tuple(ref) for ref in entry["refs"]]
+        else:
+            to_scan.append((rel, st))
+
+    paths = [os.path.join(outdir, rel) for rel, _ in to_scan]
+    for (rel, st), refs in zip(to_scan, executor.map(scan_file, paths, chunksize=8)):
+        cache[rel] = {"mtime": st.st_mtime_ns, "size": st.st_size, "refs": refs}
+        results[rel] = refs
+    return results
+
+
+def verify_archive(
+        outdir: str,
+        issues: Optional[Iterable[int]] = None,
+        jobs: Optional[int] = None,
+        use_cache: bool = True) -> Tuple[Dict[str, List[Problem]], Dict[str, str]]:
+    """Checks that every page in the archive (and every stylesheet
+    they use) only refers to local files that exist and are not empty.
+    Returns the problems found in each file, along with the issue
+    directory that each stylesheet was first referenced from."""
+    # the cache is always loaded, so that re-scanning some of the
+    # files does not lose the cached results for the others
+    cache = load_cache(outdir)
+    problems = {}
+    stylesheets = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        page_refs = collect_references(outdir, find_pages(outdir, issues), cache, executor, use_cache)
+        for page, refs in page_refs.items():
+            base_dir = os.path.join(outdir, os.path.dirname(page))
+            problems[page] = [p for p in (check_reference(k, u, base_dir) for k, u in refs) if p is not None]
+
+            for kind, url in refs:
+                if kind == "stylesheet" and not is_remote(url):
+                    path = resolve_local(url, base_dir)
+                    if os.path.isfile(path):
+                        stylesheets.setdefault(os.path.relpath(path, outdir), os.path.dirname(page))
+
+        css_refs = collect_references(outdir, sorted(stylesheets), cache, executor, use_cache)
+        for css, refs in css_refs.items():
+            base_dir = os.path.join(outdir, os.path.dirname(css))
+            problems[css] = []
+            for kind, url in refs:
+                problem = check_reference(kind, url, base_dir)
+                if problem is not None and problem[0] == "missing":
+                    actual_path = find_misplaced(outdir, problem[2], stylesheets[css])
+                    if actual_path is not None:
+                        problem = ("misplaced", url, actual_path)
+                if problem is not None:
+                    problems[css].append(problem)
+
+    save_cache(outdir, cache)
+
+    problems = {k: list(dict.fromkeys(v)) for k, v in problems.items() if v}
+    return problems, stylesheets
+
+
+def localize_remote_css(localizer: Localizer, raw_data: str, in_subdir: bool) -> str:
+    """Downloads any resources in 'url()' CSS expressions that still
+    point to a remote URL, leaving the local ones as they are."""
+    def replace(match_obj: re.Match) -> str:
+        if not is_remote(match_obj.group(1)):
+            return match_obj.group(0)
+        return localizer.localize_one_css_url(match_obj, match_obj.group(1), in_subdir)
+
+    return CSS_URL_PATTERN.sub(replace, raw_data)
+
+
+def relink_css(path: str, relinks: Dict[str, str]) -> None:
+    """Points 'url()' expressions in a stylesheet at the files that
+    they were meant to refer to, given a mapping from the current URL
+    to the actual location of the file."""
+    css_dir = os.path.dirname(path)
+
+    def replace(match_obj: re.Match) -> str:
+        url = match_obj.group(1)
+        if url not in relinks:
+            return match_obj.group(0)
+        rel_path = os.path.relpath(relinks[url], css_dir).replace(os.sep, "/")
+        return f'url("{quote(rel_path)}")'
+
+    with open(path, "r") as f:
+        raw_data = f.read()
+    with open(path, "w") as f:
+        f.write(CSS_URL_PATTERN.sub(replace, raw_data))
+
+
+def localize_remote_references(localizer: Localizer, path: str) -> None:
+    """Downloads the resources that an archived file still refers to
+    remotely, and rewrites the file to use the local copies."""
+    with open(path, "r") as f:
+        raw_data = f.read()
+
+    if path.endswith(".css"):
+        converted = localize_remote_css(localizer, raw_data, in_subdir=True)
+    else:
+        soup = BeautifulSoup(raw_data, 'html.parser')
+        for attr, elems, localize in (
+                ("href", soup.find_all("link", rel="stylesheet", href=True), localizer.localize_stylesheet),
+                ("src", soup.find_all("script", src=True), localizer.localize_script),
+                ("src", soup.find_all("img", src=True), localizer.localize_image),
+                ("content", soup.find_all("meta", property="og:image", content=True), localizer.localize_image)):
+            for elem in elems:
+                url = elem[attr]
+                if is_remote(url):
+                    if url.startswith("//"):
+                        url = "https:" + url
+                    elem[attr] = localize(url)
+
+        for style in soup.find_all("style"):
+            if style.string is not None:
+                style.string = localize_remote_css(localizer, style.string, in_subdir=False)
+        for elem in soup.find_all(style=True):
+            elem["style"] = localize_remote_css(localizer, elem["style"], in_subdir=False)
+        converted = str(soup)
+
+    if converted != raw_data:
+        with open(path, "w") as f:
+            f.write(converted)
+
+
+def refetch_broken(outdir: str, problems: Dict[str, List[Problem]], stylesheets: Dict[str, str]) -> None:
+    """Re-downloads only the assets that verification found to be
+    broken. Missing or empty files can only be restored if the URL
+    they were downloaded from was recorded when archiving."""
+    sources = load_sources(outdir)
+    localizers = {}
+    fetched = set()
+    # shared between the localizers, so that each URL is only tried
+    # once per run
+    failed_urls = set()
+
+    for rel, file_problems in problems.items():
+        issue_dir = stylesheets[rel] if rel in stylesheets else os.path.dirname(rel)
+        if issue_dir not in localizers:
+            localizers[issue_dir] = Localizer(
+                domain=DOMAIN, issue_urls={}, root_dir=outdir, issue_dir=issue_dir)
+            localizers[issue_dir].failed_urls = failed_urls
+        localizer = localizers[issue_dir]
+
+        relinks = {url: path for problem, url, path in file_problems if problem == "misplaced"}
+        if relinks:
+            relink_css(os.path.join(outdir, rel), relinks)
+
+        for problem, url, path in file_problems:
+            if problem not in ("missing", "empty") or path in fetched:
+                continue
+            fetched.add(path)
+            key = source_key(path, outdir)
+            if key not in sources:
+                print(f"Unknown source for {key}; re-archive the issue with --overwrite to restore it")
+                continue
+            # only this file is re-downloaded; anything else it refers
+            # to is kept if it is already on disk. The broken file is
+            # moved aside rather than deleted, so that it can be put
+            # back if the download fails
+            backup_path = None
+            if os.path.exists(path):
+                backup_path = path + ".broken"
+                os.replace(path, backup_path)
+            localizer.localize_item(
+                sources[key],
+                abs_dir=os.path.dirname(path),
+                binary=not path.endswith((".css", ".js")),
+                formatter=localizer.localize_css if path.endswith(".css") else None)
+            if backup_path is not None:
+                if os.path.isfile(path) and os.path.getsize(path) > 0:
+                    os.remove(backup_path)
+                else:
+                    os.replace(backup_path, path)
+
+        if any(problem == "remote" for problem, _, _ in file_problems):
+            localize_remote_references(localizer, os.path.join(outdir, rel))
+
+    for localizer in localizers.values():
+        localizer.save_sources()
+
+
+def print_problems(problems: Dict[str, List[Problem]]) -> None:
+    for rel, file_problems in problems.items():
+        print(rel)
+        for problem, url, path in file_problems:
+            if problem == "remote":
+                print(f"  remote URL: {url}")
+            elif problem == "missing":
+                print(f"  missing file: {url}")
+            elif problem == "broken-link":
+                print(f"  broken link: {url}")
+            elif problem == "misplaced":
+                print(f"  misplaced file: {url} (found at {path})")
+            else:
+                print(f"  empty file: {url}")
+
+    total = sum(len(v) for v in problems.values())
+    print(f"{total} problem(s) found in {len(problems)} file(s)")
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Verify that archived issues of Dragon+ magazine are self-contained.")
+    parser.add_argument("-i", "--issue", nargs="+", type=int,
+                        help="Issue numbers to verify. Separate the numbers in the list with spaces. If flag is not set, will verify all issues in the outdir.")
+    parser.add_argument("-o", "--outdir", nargs="?", default="./data",
+                        help="Directory where the archived issues are stored.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of processes to use when scanning files. Defaults to the number of CPUs.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Add this flag to re-scan every file, rather than only those that have changed since the last verification.")
+    parser.add_argument("--refetch", action="store_true",
+                        help="Add this flag to re-download any broken assets and localize any remaining remote URLs.")
+    args = parser.parse_args()
+
+    problems, stylesheets = verify_archive(args.outdir, issues=args.issue, jobs=args.jobs, use_cache=not args.no_cache)
+    print_problems(problems)
+
+    if args.refetch and problems:
+        print("Re-fetching broken assets...")
+        refetch_broken(args.outdir, problems, stylesheets)
+        problems, _ = verify_archive(args.outdir, issues=args.issue, jobs=args.jobs)
+        print_problems(problems)
+
+    sys.exit(1 if problems else 0)